@@ -2,13 +2,21 @@ import os
 import curses
 import argparse
 import sqlite3
-import datetime
+import time
 import logging
-from itertools import cycle
+import atexit
+import functools
+import types
+import pathlib
+import heapq
+import operator
+import threading
+import concurrent.futures
+from collections import deque
+from itertools import cycle, count
 
 # Настраиваем логирование для записи запросов в базу данных и прочих событий
 # Логирование настраивается в зависимости от аргументов командной строки
-size_cache = {}
 
 # Функция для загрузки конфигурации из файла
 # Она загружает параметры, такие как путь к базе данных
@@ -37,6 +45,56 @@ DB_PATH = config.get("DB_PATH")
 if not DB_PATH:
     raise ValueError("DB_PATH not set in configuration file.")
 
+# Открываем соединение с базой данных один раз и используем его во всех запросах,
+# чтобы не платить за открытие файла и разбор схемы на каждое нажатие клавиши
+# check_same_thread=False позволяет обращаться к соединению и из фоновых потоков
+# fe4.py только читает данные, поэтому база открывается в режиме только для чтения (mode=ro)
+# и в режиме autocommit: SELECT не оборачивается в неявную транзакцию
+_CONN = sqlite3.connect(f"{pathlib.Path(DB_PATH).absolute().as_uri()}?mode=ro", uri=True,
+                        isolation_level=None, check_same_thread=False, cached_statements=128)
+atexit.register(_CONN.close)
+# Соединение используется и из потока интерфейса, и из фонового потока загрузки диаграмм,
+# поэтому запросы к нему выполняются по очереди
+_DB_LOCK = threading.Lock()
+
+# Настройки SQLite: запрет записи, увеличенный кеш страниц и отображение файла в память
+# Режим журнала (WAL) задаёт save.py, он сохраняется в самом файле базы
+_CONN.execute("PRAGMA query_only=1")
+_CONN.execute("PRAGMA cache_size=-64000")
+_CONN.execute("PRAGMA mmap_size=268435456")
+_CONN.execute("PRAGMA temp_store=MEMORY")
+
+# SQL-запросы вынесены в константы, чтобы кеш подготовленных выражений
+# sqlite3 переиспользовал уже скомпилированный план между вызовами.
+# Запрос истории использует покрывающий индекс (path, timestamp, size), создаваемый в save.py
+# Запрос для получения истории размеров директории
+SIZE_HISTORY_QUERY = """
+    SELECT timestamp, size FROM directory_snapshot
+    WHERE path = ?
+    ORDER BY timestamp
+"""
+
+# Запрос для получения последних размеров набора директорий
+# Плейсхолдеры для IN подставляются по числу путей в пачке.
+# save.py хранит последний размер каждого пути в таблице latest_size; в базе, которую ещё не
+# обновлял новый save.py, её нет, и тогда последний размер берётся из истории
+# (SQLite берёт size из той же строки, что и MAX(timestamp))
+if _CONN.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'latest_size'").fetchone():
+    LAST_SNAPSHOT_QUERY = """
+        SELECT path, size
+        FROM latest_size
+        WHERE path IN ({placeholders})
+    """
+else:
+    LAST_SNAPSHOT_QUERY = """
+        SELECT path, MAX(timestamp) AS latest_time, size
+        FROM directory_snapshot
+        WHERE path IN ({placeholders})
+        GROUP BY path
+    """
+# Максимальное число путей в одном запросе (старые сборки SQLite допускают не более 999 параметров)
+SNAPSHOT_BATCH_SIZE = 500
+
 # Функция для обработки аргументов командной строки
 # Она позволяет указать директорию, которую нужно отобразить
 # По умолчанию будет использоваться текущая рабочая директория
@@ -63,126 +121,303 @@ if args.debug:
 else:
     logging.basicConfig(level=logging.CRITICAL)  # Отключение логирования, если флаг --debug не задан
 
+# Флаг отладочного режима: сообщения для журнала формируются только при --debug,
+# иначе строки для logging не собираются вовсе.
+# Проверки записаны как `if __debug__ and DEBUG:`, поэтому при запуске с `python -O`
+# компилятор удаляет их из кода целиком (вместе с отладочным журналом)
+DEBUG = args.debug
+logger = logging.getLogger(__name__)
+
+# Кеш с вытеснением по алгоритму LRU-K (по умолчанию K=2)
+# Вытесняется запись, у которой K-е с конца обращение было раньше всех остальных.
+# Записи, к которым обращались меньше K раз, вытесняются первыми, поэтому директории,
+# через которые пользователь один раз пролистал список, не вытесняют часто используемые данные.
+# Обращения к одному и тому же ключу подряд (повторная выборка при перерисовке, опрос фоновой загрузки,
+# стрелки влево/вправо по диаграмме) коррелированы и считаются одним обращением
+class LRUKCache:
+    def __init__(self, capacity, k=2):
+        self.capacity = capacity
+        self.k = k
+        self._values = {}
+        self._history = {}  # ключ -> время последних K обращений
+        self._heap = []  # (K-е с конца обращение, последнее обращение, ключ); устаревшие элементы пропускаются
+        self._clock = count()
+        self._last_key = None  # ключ последнего учтённого обращения
+        self._lock = threading.Lock()  # кеш используется и из фонового потока
+
+    # Приоритет вытеснения: время K-го с конца обращения или -inf, если обращений меньше K
+    def _priority(self, history):
+        return history[0] if len(history) == self.k else float('-inf')
+
+    # Регистрирует обращение к ключу
+    def _touch(self, key):
+        history = self._history.get(key)
+        if history is not None and key == self._last_key:
+            return  # Повторное обращение подряд не добавляется в историю
+        self._last_key = key
+        now = next(self._clock)
+        if history is None:
+            history = self._history[key] = deque(maxlen=self.k)
+        history.append(now)
+        heapq.heappush(self._heap, (self._priority(history), now, key))
+        # Куча накапливает устаревшие элементы при каждом обращении, периодически перестраиваем её
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(self._priority(h), h[-1], key) for key, h in self._history.items()]
+            heapq.heapify(self._heap)
+
+    # Удаляет запись с наименьшим приоритетом
+    def _evict(self):
+        while self._heap:
+            _, last_access, key = heapq.heappop(self._heap)
+            history = self._history.get(key)
+            if history is not None and history[-1] == last_access:
+                del self._history[key]
+                del self._values[key]
+                return
+
+    def cache_clear(self):
+        with self._lock:
+            self._values.clear()
+            self._history.clear()
+            self._last_key = None
+            self._heap.clear()
+
+    # Возвращает значение из кеша по кортежу аргументов, не вызывая функцию; None, если значения нет
+    def peek(self, args):
+        with self._lock:
+            if args in self._values:
+                self._touch(args)
+                return self._values[args]
+        return None
+
+    # Использование в качестве декоратора: ключом кеша служат позиционные аргументы функции
+    # Сама функция вызывается без блокировки, чтобы медленный запрос не задерживал другие потоки
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            value = self.peek(args)
+            if value is not None:
+                return value
+            value = func(*args)
+            with self._lock:
+                if args not in self._values and len(self._values) >= self.capacity:
+                    self._evict()
+                self._values[args] = value
+                self._touch(args)
+            return value
+        wrapper.cache_clear = self.cache_clear
+        wrapper.cache_peek = self.peek
+        return wrapper
+
 # Функция для получения данных по размеру директории из базы данных
-# Сначала проверяем кеш, если данные в нем есть, используем их
-# Если данных нет, выполняем запрос в базу данных
+# Результаты кешируются в ограниченном LRU-2 кеше по пути директории,
+# поэтому повторные переходы по списку не обращаются к базе данных
+@LRUKCache(capacity=512)
 def get_directory_size_data(directory):
-    # Приводим путь к нормализованному абсолютному пути для улучшения кеширования
+    # Приводим путь к нормализованному абсолютному пути
     directory = os.path.abspath(directory)
-    if directory in size_cache:
-        logging.info(f"Cache hit for directory data: {directory}")
-        return size_cache[directory]
-
-    # Подключение к базе данных
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    # SQL-запрос для получения размеров директорий
-    query = """
-        SELECT timestamp, size FROM directory_snapshot
-        WHERE path = ?
-        ORDER BY timestamp
-    """
-    logging.info(f"{query.strip()}-- parameters: '{directory}'")
-    cursor.execute(query, (directory,))
 
-    data = cursor.fetchall()
-    conn.close()
+    if __debug__ and DEBUG:
+        logger.info("%s-- parameters: '%s'", SIZE_HISTORY_QUERY.strip(), directory)
 
-    # Сохраняем данные в кеш для дальнейшего использования
-    if data:
-        size_cache[directory] = list(data)
-    else:
-        size_cache[directory] = []
-    return data
+    # Кортеж, а не список: результат хранится в кеше и не должен изменяться вызывающим кодом
+    with _DB_LOCK:
+        return tuple(_CONN.execute(SIZE_HISTORY_QUERY, (directory,)).fetchall())
+
+# Суффиксы единиц измерения для человекочитаемого формата, по степеням 1024
+SIZE_SUFFIXES = ('B', 'K', 'M', 'G', 'T', 'P')
 
 # Функция для форматирования размера в человекочитаемый вид
 # Например, 1024 будет отображено как 1.0K, 1048576 как 1.0M и так далее
+# Результаты кешируются: одинаковые размеры (например, пустые директории) встречаются часто
+@functools.lru_cache(maxsize=4096)
 def format_size(size):
     """
     Форматирует размер в человекочитаемый формат (байты, КБ, МБ, ГБ).
     """
-    for unit in ['B', 'K', 'M', 'G', 'T']:
-        if size < 1024:
-            if unit == 'B':
-                return f"{int(size)}{unit}"
-            return f"{size:.1f}{unit}"
-        size /= 1024
-    return f"{size:.1f}P"  # На случай, если размер слишком велик
-
-# Функция для получения последнего размера директории из базы данных
-# Используется кеш для ускорения работы, если данные уже были запрошены ранее
-def get_last_snapshot_size(directory):
-    # Приводим путь к нормализованному абсолютному пути для улучшения кеширования
-    directory = os.path.abspath(directory)
-    cache_key = f"snapshot_{directory}"
-    if cache_key in size_cache and size_cache[cache_key]:
-        logging.info(f"Cache hit for directory snapshot with key: {cache_key}")
-        return size_cache[cache_key]
-    
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    if size < 1024:
+        return f"{int(size)}B"
+    # Номер единицы измерения берётся из двоичного логарифма размера, без цикла делений
+    unit_index = min((int(size).bit_length() - 1) // 10, len(SIZE_SUFFIXES) - 1)
+    return f"{size / (1 << (10 * unit_index)):.1f}{SIZE_SUFFIXES[unit_index]}"
+
+# Функция для получения последних размеров заданных директорий из базы данных
+# Запрашиваются только перечисленные пути (непосредственные поддиректории), а не всё поддерево
+# Результаты хранятся в ограниченном LRU-2 кеше, ключ - кортеж путей
+@LRUKCache(capacity=256)
+def get_last_snapshot_sizes(child_paths):
+    sizes = {}
+
+    # Пути передаются пачками, чтобы не превысить лимит параметров SQLite
+    for start in range(0, len(child_paths), SNAPSHOT_BATCH_SIZE):
+        batch = child_paths[start:start + SNAPSHOT_BATCH_SIZE]
+        query = LAST_SNAPSHOT_QUERY.format(placeholders=", ".join("?" * len(batch)))
+        if __debug__ and DEBUG:
+            logger.info("%s -- parameters: %d paths", query.strip(), len(batch))
+        with _DB_LOCK:
+            rows = _CONN.execute(query, batch).fetchall()
+        sizes.update((row[0], row[-1]) for row in rows)
+
+    # Словарь отдаётся только для чтения, так как он хранится в кеше
+    return types.MappingProxyType(sizes)
+
+# История размеров для диаграммы загружается в отдельном потоке, чтобы стрелки вверх/вниз
+# не ждали запроса к базе данных. Один поток: запросы всё равно выполняются по очереди
+_size_data_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+# Загрузка для единственной директории, которую ждёт интерфейс: (путь, Future) или None.
+# Загрузки для директорий, с которых пользователь уже ушёл, отменяются и не накапливаются
+_pending_size_data = None
+# Как часто (в мс) проверять готовность фоновой загрузки, пока она не завершилась
+SIZE_DATA_POLL_MS = 30
+
+# Функция для неблокирующего получения истории размеров директории
+# Возвращает данные, если они уже в кеше или загружены, иначе ставит загрузку в очередь и возвращает None
+def fetch_directory_size_data(directory):
+    global _pending_size_data
+
+    if _pending_size_data is not None:
+        pending_directory, future = _pending_size_data
+        if pending_directory == directory:
+            if not future.done():
+                return None
+            _pending_size_data = None
+            return future.result()  # Ошибка запроса пробрасывается в поток интерфейса
+        # Выделение сменилось: ещё не начатый запрос для прежней директории не нужен,
+        # а уже выполняющийся просто положит результат в кеш
+        future.cancel()
+        _pending_size_data = None
+
+    size_data = get_directory_size_data.cache_peek((directory,))
+    if size_data is not None:
+        return size_data
+
+    _pending_size_data = (directory, _size_data_executor.submit(get_directory_size_data, directory))
+    return None
+
+# Функция для сброса кешей данных о размерах
+# Нужна для принудительного перечитывания базы данных (например, по клавише обновления)
+def size_cache_clear():
+    get_directory_size_data.cache_clear()
+    get_last_snapshot_sizes.cache_clear()
+
+# Кеш рассчитанных высот столбцов: (id(size_data), max_height) -> (size_data, высоты столбцов)
+# Ссылка на size_data хранится вместе с результатом, поэтому id не может достаться другому объекту
+_chart_cache = {}
+CHART_CACHE_SIZE = 256
+
+# Функция для расчёта высот всех столбцов диаграммы с учётом максимального размера
+# Данные о размерах не меняются между нажатиями клавиш, поэтому результат кешируется
+def get_bar_heights(size_data, max_height):
+    cache_key = (id(size_data), max_height)
+    cached = _chart_cache.get(cache_key)
+    if cached is not None:
+        return cached[1]
 
-    # SQL-запрос для получения последних размеров всех поддиректорий
-    query = """
-        SELECT path, MAX(timestamp) AS latest_time, size
-        FROM directory_snapshot
-        WHERE path LIKE ?
-        GROUP BY path
-    """
-    logging.info(f"{query.strip()} -- parameters: '{directory}%' ")
-    cursor.execute(query, (f"{directory}%",))
+    max_size = max(size for _, size in size_data)
+    if max_size == 0:
+        bar_heights = None  # Нечего отображать, все размеры равны нулю
+    else:
+        bar_heights = tuple(int((size / max_size) * max_height) for _, size in size_data)
 
-    data = cursor.fetchall()
-    conn.close()
+    if len(_chart_cache) >= CHART_CACHE_SIZE:
+        _chart_cache.clear()
+    _chart_cache[cache_key] = (size_data, bar_heights)
+    return bar_heights
 
-    # Сохраняем данные в кеш
-    if data:
-        size_cache[cache_key] = {row[0]: row[2] for row in data if len(row) >= 3}
-    else:
-        size_cache[cache_key] = {}
-    return size_cache[cache_key]
+# Функция для расчёта геометрии диаграммы: высоты, количество и ширина столбцов
+# Возвращает None, если отображать нечего
+def get_bar_chart_layout(size_data, max_height, max_width, bar_offset):
+    if not size_data:
+        return None
+
+    bar_heights = get_bar_heights(size_data, max_height)
+    if bar_heights is None:
+        return None
+
+    num_bars = min(len(size_data) - bar_offset, max_width - 2)
+    if num_bars <= 0:
+        return None  # Смещение вышло за пределы данных
+    bar_width = max(1, max_width // num_bars)
+    return bar_heights, num_bars, bar_width
+
+# Функция для форматирования даты и времени снимка
+# time.strftime не создаёт объект datetime; результаты кешируются по метке времени
+@functools.lru_cache(maxsize=1024)
+def format_timestamp(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+# Функция для отрисовки одного столбца диаграммы
+# Под выделенным столбцом отображается его дата, время и размер
+def draw_bar(stdscr, size_data, layout, bar_index, start_row, bar_offset, is_selected, current_unit):
+    bar_heights, _, bar_width = layout
+    timestamp, size = size_data[bar_offset + bar_index]
+    bar_height = bar_heights[bar_offset + bar_index]
+    bar_x = bar_index * bar_width + 1
+    color = curses.A_REVERSE if is_selected else curses.A_NORMAL
+
+    addstr = stdscr.addstr  # Локальная ссылка вместо поиска атрибута на каждой итерации
+    for j in range(bar_height):
+        addstr(start_row - j, bar_x, '#', color)
+
+    # Отображаем дату, время и размер под выделенным столбцом
+    if is_selected:
+        date_time_str = format_timestamp(timestamp)
+        size_str = format_size_by_unit(size, current_unit)
+        stdscr.addstr(start_row + 1, 0, f"Date/Time: {date_time_str}, Size ({current_unit}): {size_str}")
 
 # Функция для отображения диаграммы размеров директорий с использованием символов #
 # Она отображает исторические данные о размере директории в виде столбиков
 # Также отображает дату и время для выбранной директории
 def draw_bar_chart(stdscr, size_data, start_row, max_height, max_width, bar_offset, selected_bar, target_directory, current_unit):
-    if not size_data:
+    layout = get_bar_chart_layout(size_data, max_height, max_width, bar_offset)
+    if layout is None:
         return
 
-    max_size = max(size for _, size in size_data)
-
-    if max_size == 0:
-        return  # Нечего отображать, все размеры равны нулю
-
-    num_bars = min(len(size_data) - bar_offset, max_width - 2)
-    bar_width = max(1, max_width // num_bars)
-
-    for i, (timestamp, size) in enumerate(size_data[bar_offset:bar_offset + num_bars]):
-        bar_height = int((size / max_size) * max_height)
-        bar_x = i * bar_width + 1
-        color = curses.A_REVERSE if i == selected_bar else curses.A_NORMAL
+    all_heights, num_bars, bar_width = layout
+    bar_heights = all_heights[bar_offset:bar_offset + num_bars]
+
+    # Рисуем диаграмму построчно: одна строка через все столбцы за один вызов addstr
+    gap = " " * (bar_width - 1)
+    addstr = stdscr.addstr
+    A_NORMAL = curses.A_NORMAL
+    for j in range(max(bar_heights)):
+        line = gap.join('#' if bar_height > j else ' ' for bar_height in bar_heights).rstrip()
+        addstr(start_row - j, 1, line, A_NORMAL)
+
+    # Поверх рисуем выделенный столбец вместе с подписью под ним
+    if 0 <= selected_bar < num_bars:
+        draw_bar(stdscr, size_data, layout, selected_bar, start_row, bar_offset, True, current_unit)
+
+# Функция для обновления диаграммы при смене выделенного столбца
+# Перерисовываются только ранее выделенный и новый выделенный столбцы, а также подпись под ними
+def redraw_selected_bars(stdscr, size_data, start_row, max_height, max_width, bar_offset, prev_selected_bar, selected_bar, current_unit):
+    layout = get_bar_chart_layout(size_data, max_height, max_width, bar_offset)
+    if layout is None:
+        return
 
-        for j in range(bar_height):
-            stdscr.addstr(start_row - j, bar_x, '#', color)
-        
-        # Отображаем дату, время и размер под выделенным столбцом
-        if i == selected_bar:
-            date_time_str = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
-            size_str = format_size_by_unit(size, current_unit)
-            stdscr.addstr(start_row + 1, 0, f"Date/Time: {date_time_str}, Size ({current_unit}): {size_str}")
+    num_bars = layout[1]
+    if 0 <= prev_selected_bar < num_bars:
+        draw_bar(stdscr, size_data, layout, prev_selected_bar, start_row, bar_offset, False, current_unit)
+    stdscr.move(start_row + 1, 0)
+    stdscr.clrtoeol()
+    if 0 <= selected_bar < num_bars:
+        draw_bar(stdscr, size_data, layout, selected_bar, start_row, bar_offset, True, current_unit)
 
 # Список доступных единиц измерения размера
 # 'HR' означает "человекочитаемый" (Human Readable)
 size_units = ['HR', 'TB', 'GB', 'MB', 'KB', 'B']
 size_format_cyclers = {}  # хранение текущего состояния единиц измерения для каждой директории
 
+# Ключ сортировки списка директорий: размер - третий элемент кортежа (имя, путь, размер)
+SORT_BY_SIZE = operator.itemgetter(2)
+
 # Функция для получения следующей единицы измерения размера
 # Используется для переключения между различными единицами измерения
 def get_next_unit(size, units, current_index):
     # Всегда переключаем на следующую единицу измерения, даже если размер равен 0 или меньше 0.01
     next_index = (current_index + 1)% len(units)
-    logging.info(f"Next index: {next_index}")
+    if __debug__ and DEBUG:
+        logger.info("Next index: %s", next_index)
     for i in range(next_index, len(units)):
         next_unit = units[i]
         if next_unit == 'HR' or format_size_in_unit(size, next_unit) >= 0.01:
@@ -199,19 +434,23 @@ def update_size_units(size):
             valid_units.append(unit)
     return valid_units
 
+# Множители единиц измерения: степени 1024 записаны сдвигами и вычисляются один раз при загрузке модуля
+UNIT_MULTIPLIERS = {
+    'TB': 1 << 40,
+    'GB': 1 << 30,
+    'MB': 1 << 20,
+    'KB': 1 << 10,
+    'B': 1,
+}
+
 # Функция для преобразования размера в определенную единицу измерения
 def format_size_in_unit(size, unit):
-    unit_multipliers = {
-        'TB': 1024**4,
-        'GB': 1024**3,
-        'MB': 1024**2,
-        'KB': 1024,
-        'B': 1,
-    }
-    return size / unit_multipliers[unit]
+    return size / UNIT_MULTIPLIERS[unit]
 
 # Функция для форматирования размера в заданной единице
 # Если единица 'HR', используется форматирование в человекочитаемый вид
+# Результат зависит только от аргументов, поэтому кешируется так же, как format_size
+@functools.lru_cache(maxsize=4096)
 def format_size_by_unit(size, unit):
     if unit == 'HR':
         return format_size(size)
@@ -222,6 +461,28 @@ def format_size_by_unit(size, unit):
         return f"{value:.2f} {unit}"
     
 
+# Функция для отрисовки одной строки списка директорий
+# rendered_row - заранее подготовленный кортеж (обычная строка, выделенная строка, размер, длина имени)
+# Выделенная строка помечается символом '>' и инверсным отображением размера
+def draw_directory_row(stdscr, row, rendered_row, is_selected, size_column_start):
+    plain_name, marked_name, size_display, _ = rendered_row
+    # clrtoeol очищает строку одной командой терминала вместо записи строки из пробелов
+    stdscr.move(row, 0)
+    stdscr.clrtoeol()
+    stdscr.addstr(row, 0, marked_name if is_selected else plain_name)
+    stdscr.addstr(
+        row,
+        size_column_start,
+        size_display,
+        curses.A_REVERSE if is_selected else 0
+    )
+
+# Функция для вывода внеэкранного буфера на терминал
+# ncurses сравнивает буфер с текущим содержимым экрана и отправляет только изменившиеся ячейки
+def flush_buffer(buf, height, width):
+    buf.noutrefresh(0, 0, 0, 0, height - 1, width - 1)
+    curses.doupdate()
+
 # Основная функция для отображения списка директорий с использованием ncurses
 # Пользователь может взаимодействовать с интерфейсом, используя клавиши вверх/вниз, влево/вправо, 'b' для смены единицы измерения, Enter для выбора директории
 # Отображается список директорий и размеры каждой директории
@@ -229,19 +490,36 @@ def display_directories(stdscr, target_directory):
     previous_directory = None
     bar_offset = 0
     selected_bar = 0
+    # Последние загруженные данные диаграммы; показываются, пока для новой директории идёт загрузка
+    size_data = ()
+    # Выделение переносится на последний столбец, когда загрузятся данные для новой выбранной директории
+    reset_selected_bar = False
+
+    # Весь вывод идёт во внеэкранный буфер (pad), на сам stdscr ничего не пишется.
+    # Фиксируем его пустое состояние, чтобы getch() не перерисовывал stdscr поверх буфера
+    buf = None
+    stdscr.noutrefresh()
 
     while True:
         # Получаем список директорий в целевой директории
-        directories = [d for d in os.listdir(target_directory) if os.path.isdir(os.path.join(target_directory, d))]
-        directories_sizes = get_last_snapshot_size(target_directory)
-
-        # Сортируем директории по размеру (по убыванию)
-        directories = sorted(directories, key=lambda d: directories_sizes.get(os.path.join(target_directory, d), 0), reverse=True)
+        # os.scandir отдаёт тип записи вместе с именем, поэтому отдельный stat на каждую запись не нужен
+        with os.scandir(target_directory) as it:
+            entries = [e for e in it if e.is_dir(follow_symlinks=False)]
+        # Пары (имя, полный путь) строятся один раз и используются и для сортировки, и для поиска размеров
+        pairs = [(e.name, e.path) for e in entries]
+        directories_sizes = get_last_snapshot_sizes(tuple(p for _, p in pairs))
 
         # Форматируем список директорий и их размеров
+        # Полный путь хранится рядом с именем, чтобы не собирать его заново при каждом нажатии клавиши
+        # Размер ищется в словаре один раз на директорию, до сортировки
         directories_with_sizes = [
-            (d, directories_sizes.get(os.path.join(target_directory, d), 0)) for d in directories
+            (d, p, directories_sizes.get(p, 0)) for d, p in pairs
         ]
+
+        # Сортируем директории по размеру (по убыванию)
+        # itemgetter выполняется на уровне C, без вызова lambda на каждый элемент;
+        # сортировка устойчива, поэтому порядок директорий с одинаковым размером не меняется
+        directories_with_sizes.sort(key=SORT_BY_SIZE, reverse=True)
         if target_directory not in size_format_cyclers:
             initial_size = sum(directories_sizes.values()) if directories_sizes else 0
             size_format_cyclers[target_directory] = {
@@ -253,15 +531,23 @@ def display_directories(stdscr, target_directory):
         # Добавляем родительскую директорию, если возможно (для возможности навигации вверх)
         parent_directory = os.path.abspath(os.path.join(target_directory, ".."))
         if parent_directory != target_directory:
-            directories_with_sizes.insert(0, ("..", 0)) 
+            directories_with_sizes.insert(0, ("..", parent_directory, 0))
+
+        # Готовим строки списка один раз на каждый вход в директорию, а не на каждое нажатие клавиши
+        rendered_rows = [(f"  {d}", f"> {d}", format_size(size), len(d)) for d, _, size in directories_with_sizes]
+        # Индекс имени в списке для быстрого восстановления выделения при возврате из поддиректории
+        name_to_idx = {d: i for i, (d, _, _) in enumerate(directories_with_sizes)}
 
-        # Очищаем экран и готовимся к отображению списка директорий
+        # Очищаем буфер и готовимся к отображению списка директорий
+        # erase() не заставляет терминал перерисовываться целиком, в отличие от clear()
         curses.curs_set(0)
-        stdscr.clear()
         height, width = stdscr.getmaxyx()
+        if buf is None or buf.getmaxyx() != (height, width):
+            buf = curses.newpad(height, width)
+        buf.erase()
 
         # Определяем максимальную длину имени поддиректорий и позицию для отображения размеров
-        max_dir_name_length = max(len(d) for d, _ in directories_with_sizes) + 2
+        max_dir_name_length = max(row[3] for row in rendered_rows) + 2
         size_column_start = max_dir_name_length + 2
 
         half_height = height // 2
@@ -272,63 +558,107 @@ def display_directories(stdscr, target_directory):
 
         # Если мы возвращаемся в предыдущую директорию, пытаемся восстановить выбранную директорию
         if previous_directory:
-            try:
-                selected_idx = [d for d, _ in directories_with_sizes].index(os.path.basename(previous_directory))
-            except ValueError:
-                selected_idx = 0
+            selected_idx = name_to_idx.get(os.path.basename(previous_directory), 0)
             scroll_start = max(0, selected_idx - maxlines // 2)
             scroll_end = scroll_start + maxlines - 1
 
-        while True:
-            # Отображаем заголовок и список директорий с размерами
-            stdscr.addstr(0, 0, f"Directory listing for: {target_directory}")
-            stdscr.addstr(1, 0, "-" * width)
-
-            for idx, (dir_name, size) in enumerate(directories_with_sizes[scroll_start:scroll_end + 1]):
-                stdscr.addstr(2 + idx, 0, " " * width)
-                global_idx = scroll_start + idx
-                display_name = f"{dir_name}"
-                size_display = f"{format_size(size)}"
-                stdscr.addstr(2 + idx, 0, f"> {display_name}" if global_idx == selected_idx else f"  {display_name}")
-                stdscr.addstr(
-                    2 + idx,
-                    size_column_start,
-                    size_display,
-                    curses.A_REVERSE if global_idx == selected_idx else 0
-                )
+        # Состояние последней отрисовки списка: None означает, что список нужно нарисовать целиком
+        prev_selected_idx = None
+        prev_scroll_start = None
+        # Состояние последней отрисовки диаграммы: она перерисуется, только если изменился ключ
+        last_chart_key = None
+        last_selected_bar = None
 
-            stdscr.addstr(half_height - 1, 0, "-" * width)
+        # Локальные ссылки на часто вызываемые методы окна для цикла обработки клавиш
+        addstr = buf.addstr
+        getch = stdscr.getch
 
-            # Отображаем текущую выбранную директорию
-            selected_dir = directories_with_sizes[selected_idx][0]
-            logging.info(f"Current selected directory: {selected_dir}")
-            stdscr.addstr(half_height, 0, f"Current selection: {selected_dir}")
+        # Строки, которые не меняются до смены директории, собираются один раз
+        header = f"Directory listing for: {target_directory}"
+        separator = "-" * width
+
+        while True:
+            # Признак того, что в буфере что-то изменилось и его нужно вывести на экран
+            dirty = False
+            if scroll_start != prev_scroll_start:
+                dirty = True
+                # Отображаем заголовок и список директорий с размерами
+                addstr(0, 0, header)
+                addstr(1, 0, separator)
+
+                for idx, rendered_row in enumerate(rendered_rows[scroll_start:scroll_end + 1]):
+                    global_idx = scroll_start + idx
+                    draw_directory_row(buf, 2 + idx, rendered_row, global_idx == selected_idx, size_column_start)
+
+                addstr(half_height - 1, 0, separator)
+            elif selected_idx != prev_selected_idx:
+                dirty = True
+                # Окно прокрутки не сдвинулось: перерисовываем только строки старого и нового выделения
+                for global_idx in (prev_selected_idx, selected_idx):
+                    draw_directory_row(buf, 2 + global_idx - scroll_start, rendered_rows[global_idx], global_idx == selected_idx, size_column_start)
+            prev_selected_idx = selected_idx
+            prev_scroll_start = scroll_start
+
+            selected_dir, selected_path, _ = directories_with_sizes[selected_idx]
+            if __debug__ and DEBUG:
+                logger.info("Current selected directory: %s", selected_dir)
 
             # Получаем данные о размерах для выбранной директории
-            size_data = get_directory_size_data(os.path.join(target_directory, selected_dir))
-
-            # Очищаем область диаграммы
-            for row in range(half_height, height - 2):
-                stdscr.addstr(row, 0, " " * width)
-
-            # Отображаем диаграмму для выбранной директории
-            draw_bar_chart(
-                stdscr, size_data,
-                start_row=height - 5,
-                max_height=height - half_height - 6,
-                max_width=width,
-                bar_offset=bar_offset,
-                selected_bar=selected_bar,
-                target_directory=target_directory,
-                current_unit=current_unit
-            )
-
-            # Инструкция для пользователя
-            stdscr.addstr(height - 1, 0, "Press 'q' to quit, Enter to select")
-            stdscr.refresh()
+            # Пока они загружаются в фоновом потоке, getch ждёт клавишу недолго, чтобы вовремя показать результат
+            loaded_size_data = fetch_directory_size_data(selected_path)
+            if loaded_size_data is not None:
+                size_data = loaded_size_data
+                if reset_selected_bar:
+                    selected_bar = len(size_data) - 1 if size_data else 0
+                    reset_selected_bar = False
+            stdscr.timeout(-1 if loaded_size_data is not None else SIZE_DATA_POLL_MS)
+
+            chart_key = (selected_path, bar_offset, current_unit, height, width, id(size_data))
+            if chart_key != last_chart_key:
+                dirty = True
+                # Очищаем область диаграммы до конца экрана вместе со строкой инструкции
+                buf.move(half_height, 0)
+                buf.clrtobot()
+
+                # Инструкция для пользователя
+                addstr(height - 1, 0, "Press 'q' to quit, Enter to select")
+
+                # Отображаем текущую выбранную директорию
+                addstr(half_height, 0, f"Current selection: {selected_dir}")
+
+                # Отображаем диаграмму для выбранной директории
+                draw_bar_chart(
+                    buf, size_data,
+                    start_row=height - 5,
+                    max_height=height - half_height - 6,
+                    max_width=width,
+                    bar_offset=bar_offset,
+                    selected_bar=selected_bar,
+                    target_directory=target_directory,
+                    current_unit=current_unit
+                )
+            elif selected_bar != last_selected_bar:
+                dirty = True
+                # Сменился только выделенный столбец: перерисовываем два столбца вместо всей диаграммы
+                redraw_selected_bars(
+                    buf, size_data,
+                    start_row=height - 5,
+                    max_height=height - half_height - 6,
+                    max_width=width,
+                    bar_offset=bar_offset,
+                    prev_selected_bar=last_selected_bar,
+                    selected_bar=selected_bar,
+                    current_unit=current_unit
+                )
+            last_chart_key = chart_key
+            last_selected_bar = selected_bar
+
+            # Если после нажатия клавиши ничего не изменилось, экран не обновляем
+            if dirty:
+                flush_buffer(buf, height, width)
 
             # Обработка ввода от пользователя
-            key = stdscr.getch()
+            key = getch()
             if key == curses.KEY_HOME or key == 126:  # Добавляем обработку клавиши Home (код 126)
                 selected_idx = 0
                 scroll_start = 0
@@ -354,40 +684,39 @@ def display_directories(stdscr, target_directory):
                     selected_idx -= 1
                 elif scroll_start > 0:
                     scroll_start -= 1
-                # Обновляем выбранную диаграмму для новой директории
-                size_data = get_directory_size_data(os.path.join(target_directory, directories_with_sizes[selected_idx][0]))
-                selected_bar = len(size_data) - 1 if size_data else 0
+                # Диаграмма для новой директории обновится, когда загрузятся её данные
+                reset_selected_bar = True
             elif key == curses.KEY_DOWN:
                 if selected_idx < len(directories_with_sizes) - 1:
                     selected_idx += 1
-                # Обновляем выбранную диаграмму для новой директории
-                size_data = get_directory_size_data(os.path.join(target_directory, directories_with_sizes[selected_idx][0]))
-                selected_bar = len(size_data) - 1 if size_data else 0
+                # Диаграмма для новой директории обновится, когда загрузятся её данные
+                reset_selected_bar = True
             elif key == ord('b'):
-                logging.info(f"'b' key pressed to change size unit for selected directory.")
+                if __debug__ and DEBUG:
+                    logger.info("'b' key pressed to change size unit for selected directory.")
                 # Обновляем индекс единицы измерения, переключаясь на следующую
                 size_format_cyclers[target_directory]['index'] = (size_format_cyclers[target_directory]['index'] ) % len(size_format_cyclers[target_directory]['units'])
                 current_unit = size_format_cyclers[target_directory]['units'][size_format_cyclers[target_directory]['index']]
                 # Обновляем единицу измерения для текущей директории
                 size_format_cyclers[target_directory]['index'], current_unit = get_next_unit(
-                    directories_with_sizes[selected_idx][1],
+                    directories_with_sizes[selected_idx][2],
                     size_format_cyclers[target_directory]['units'],
                     size_format_cyclers[target_directory]['index']
                 )
-                logging.info(f"Updated size unit to: {current_unit}")
-                selected_size = directories_with_sizes[selected_idx][1]
+                if __debug__ and DEBUG:
+                    logger.info("Updated size unit to: %s", current_unit)
+                selected_size = directories_with_sizes[selected_idx][2]
                 size_str = format_size_by_unit(selected_size, current_unit)
-                stdscr.addstr(half_height + 1, 0, f"Current selection: {selected_dir}, Size ({current_unit}): {size_str}")
-                stdscr.refresh()
+                addstr(half_height + 1, 0, f"Current selection: {selected_dir}, Size ({current_unit}): {size_str}")
+                flush_buffer(buf, height, width)
             elif key == curses.KEY_ENTER or key == 10 or key == 13:
                 # Переход в выбранную директорию или возврат на уровень вверх
-                selected_dir = directories_with_sizes[selected_idx][0]
+                selected_dir, selected_path, _ = directories_with_sizes[selected_idx]
                 if selected_dir == "..":
                     previous_directory = target_directory
-                    target_directory = os.path.abspath(os.path.join(target_directory, ".."))
                 else:
-                    target_directory = os.path.join(target_directory, selected_dir)
                     previous_directory = None
+                target_directory = selected_path
                 break
 
             # Обновляем окно прокрутки в случае, если выбранный элемент выходит за пределы текущего экрана
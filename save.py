@@ -4,7 +4,17 @@ import time
 import argparse
 import psutil
 import sys
-from collections import deque
+import functools
+import concurrent.futures
+
+# Обход файловой системы упирается в системные вызовы scandir/stat, которые отпускают GIL,
+# поэтому поддеревья сканируются параллельно в пуле потоков
+SCAN_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# Глубина, начиная с которой поддеревья целиком отдаются в потоки пула; верхние уровни читаются в основном потоке
+PARALLEL_SCAN_DEPTH = 2
+
+# Разделитель пути для обхода директорий по путям в bytes
+BYTES_SEP = os.fsencode(os.sep)
 
 # Функция для обработки командной строки
 def parse_arguments():
@@ -32,18 +42,54 @@ def read_config(config_file='config.txt'):
         exit(1)
 
 # Определение, выполняется ли программа в cron
+# Окружение и терминал не меняются во время работы, поэтому результат вычисляется один раз
+@functools.lru_cache(maxsize=None)
 def is_running_in_cron():
     return os.getenv('X_CRON') is not None or not sys.stdout.isatty()
 
+# Журнал INSERT-запросов в query_log.txt ведётся только по запросу: он повторяет один и тот же шаблон
+# для каждой изменившейся директории и без надобности растёт при каждом запуске из cron
+def is_query_log_enabled():
+    return os.getenv('X_QUERY_LOG') is not None
+
 # Определяем файловую систему корневой директории
+# Результат кешируется: повторяющиеся цели не вызывают os.stat повторно
+@functools.lru_cache(maxsize=None)
 def get_root_dev(path):
     return os.stat(path).st_dev
 
+# Файловые системы, которые не сканируются: псевдо-файловые системы, образы и сетевые подключения
+PSEUDO_FSTYPES = frozenset({"proc", "sysfs", "tmpfs", "devpts", "cgroup", "squashfs", "devtmpfs", "overlay", "fusectl", "fuse.sshfs"})
+
+@functools.lru_cache(maxsize=1)
+def get_mounts():
+    """
+    Возвращает (все точки монтирования, исключённые точки монтирования, префиксы путей внутри исключённых).
+    Точки монтирования и префиксы возвращаются в виде bytes, как пути при обходе (см. get_directory_sizes).
+    Список разделов читается один раз за запуск, повторные вызовы record_sizes используют готовый результат.
+    """
+    partitions = psutil.disk_partitions(all=True)
+    # Все точки монтирования: обход не заходит ни в одну из них и остаётся в пределах файловой системы цели
+    mountpoints = frozenset(os.fsencode(partition.mountpoint) for partition in partitions)
+    excluded_mounts = frozenset(partition.mountpoint for partition in partitions if "loop" in partition.opts or partition.fstype in PSEUDO_FSTYPES)
+    # Префиксы путей внутри исключённых точек монтирования. Завершающий '/' не даёт '/var/lib' совпасть с '/var/libfoo',
+    # а кортеж позволяет проверить все префиксы одним вызовом str.startswith
+    excluded_prefixes = tuple(os.fsencode(mount.rstrip('/') + '/') for mount in excluded_mounts)
+    return mountpoints, excluded_mounts, excluded_prefixes
+
 def initialize_database(db_path):
     """
-    Создает таблицу в базе данных для хранения информации о размерах (выполняется один раз).
+    Создает таблицы в базе данных для хранения информации о размерах (выполняется один раз).
+    directory_snapshot хранит всю историю размеров, latest_size - только последний размер каждого пути.
     """
     with sqlite3.connect(db_path) as conn:
+        # Размер страницы 8 КБ: в страницу индекса помещается больше путей, B-дерево получается ниже.
+        # Действует только для новой базы и должен быть задан до включения WAL, для существующей базы он игнорируется
+        conn.execute('PRAGMA page_size=8192')
+        # Режим WAL сохраняется в файле базы, поэтому его достаточно включить при создании;
+        # fe4.py открывает базу только для чтения и рассчитывает на него
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
         cursor = conn.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS directory_snapshot (
@@ -53,100 +99,248 @@ def initialize_database(db_path):
                 timestamp INTEGER
             );
         ''')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_path_timestamp ON directory_snapshot (path, timestamp);')
+        # Покрывающий индекс: выборки по пути с сортировкой по времени читают только индекс, без обращения к таблице.
+        # Он заменяет прежний индекс (path, timestamp) и индекс, который раньше создавал fe4.py
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_path_ts_size ON directory_snapshot (path, timestamp, size);')
+        cursor.execute('DROP INDEX IF EXISTS idx_path_timestamp;')
+        cursor.execute('DROP INDEX IF EXISTS idx_snap_path_ts;')
+
+        # Последний размер каждого пути, чтобы не перебирать всю историю ради одной строки.
+        # WITHOUT ROWID хранит строки прямо в B-дереве по пути: выборка диапазона путей читает только его.
+        # При первом создании таблица заполняется из уже накопленной истории
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'latest_size'")
+        latest_size_exists = cursor.fetchone() is not None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS latest_size (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                timestamp INTEGER
+            ) WITHOUT ROWID;
+        ''')
+        if not latest_size_exists:
+            cursor.execute('''
+                INSERT OR REPLACE INTO latest_size (path, size, timestamp)
+                SELECT path, size, MAX(timestamp) FROM directory_snapshot
+                GROUP BY path;
+            ''')
         conn.commit()
 
-def get_size(path, root_dev, excluded_mounts):
+def scan_directory(path, root_dev, excluded_prefixes, mountpoints):
     """
-    Возвращает размер директории. Работает только в пределах одной файловой системы и игнорирует примонтированные поддиректории.
+    Читает директорию одним вызовом scandir и возвращает пару (размер файлов, список поддиректорий).
+    Размер включает только обычные файлы, лежащие непосредственно в директории.
+    Файлы и поддиректории с другой файловой системы и из исключённых точек монтирования пропускаются.
+    Возвращает None, если директорию прочитать нельзя.
     """
-    total_size = 0
-    stack = deque([path])
+    own_size = 0
+    subdirs = []
+    # Путь файла начинается с префикса исключённой точки монтирования тогда и только тогда, когда с него
+    # начинается путь директории с завершающим '/', поэтому проверка делается один раз на директорию
+    files_excluded = (path.rstrip(BYTES_SEP) + BYTES_SEP).startswith(excluded_prefixes)
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                # Тип записи известен из readdir, поэтому stat вызывается один раз и только для нужных записей
+                if entry.is_dir(follow_symlinks=False):
+                    # Известные точки монтирования отсекаются по множеству без системного вызова
+                    if entry.path in mountpoints:
+                        continue
+                    # Остальные переходы на другую файловую систему (например, подтома btrfs, которых нет
+                    # в списке разделов) определяются по st_dev: один lstat на поддиректорию
+                    try:
+                        if entry.stat(follow_symlinks=False).st_dev != root_dev:
+                            continue
+                    except OSError:
+                        continue
+                    subdirs.append(entry.path)
+                elif not files_excluded and entry.is_file(follow_symlinks=False):
+                    # Результат stat кешируется в DirEntry: если is_dir/is_file уже вызвали lstat
+                    # (файловая система не сообщает тип записи), повторного системного вызова не будет
+                    try:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue  # Файл удалён или недоступен после чтения директории
+                    # Игнорируем примонтированные файловые системы
+                    if entry_stat.st_dev == root_dev:
+                        own_size += entry_stat.st_size
+    except (PermissionError, FileNotFoundError):
+        # Игнорируем недоступные директории и файлы
+        return None
+    return own_size, subdirs
 
+def walk_directories(top, top_parent, root_dev, excluded_prefixes, mountpoints, executor=None):
+    """
+    Обходит поддерево сверху вниз и возвращает список (путь, собственный размер, родитель) в порядке обхода.
+    Родитель равен None, если размер директории не должен входить в размер родителя.
+    Если передан executor, поддеревья на глубине PARALLEL_SCAN_DEPTH обходятся в его потоках;
+    их результаты встают в список на место поддерева, так что порядок не зависит от числа потоков.
+    """
+    entries = []  # Кортежи директорий, прочитанных здесь, и Future с результатами поддеревьев
+    stack = [(top, top_parent, 0)]
     while stack:
-        current_path = stack.pop()
-        try:
-            with os.scandir(current_path) as it:
-                for entry in it:
-                    entry_path = entry.path
-                    entry_dev = entry.stat(follow_symlinks=False).st_dev
-                    # Игнорируем примонтированные файловые системы
-                    if entry_dev != root_dev or any(entry_path.startswith(mount) for mount in excluded_mounts):
-                        continue
-                    if entry.is_dir(follow_symlinks=False):
-                        stack.append(entry_path)
-                    elif entry.is_file(follow_symlinks=False):
-                        total_size += entry.stat(follow_symlinks=False).st_size
-        except (PermissionError, FileNotFoundError):
-            # Игнорируем недоступные директории и файлы
+        dirpath, parent, depth = stack.pop()
+        if executor is not None and depth == PARALLEL_SCAN_DEPTH:
+            entries.append(executor.submit(walk_directories, dirpath, parent, root_dev, excluded_prefixes, mountpoints))
             continue
+        scanned = scan_directory(dirpath, root_dev, excluded_prefixes, mountpoints)
+        if scanned is None:
+            continue
+        own_size, subdirs = scanned
+        entries.append((dirpath, own_size, parent))
+        # В стек кладём в обратном порядке, чтобы поддиректории обходились в порядке scandir
+        stack.extend(
+            (child, None if child.startswith(excluded_prefixes) else dirpath, depth + 1)
+            for child in reversed(subdirs)
+        )
+
+    if executor is None:
+        return entries
+    result = []
+    for entry in entries:
+        if isinstance(entry, concurrent.futures.Future):
+            result.extend(entry.result())
+        else:
+            result.append(entry)
+    return result
+
+def get_directory_sizes(target_directory, root_dev, excluded_prefixes, mountpoints, executor=None):
+    """
+    Возвращает словарь {путь: размер} для целевой директории и всех её поддиректорий.
+    Каждая директория читается один раз, а размеры поддиректорий затем суммируются снизу вверх.
+    Работает только в пределах одной файловой системы и не заходит в точки монтирования из mountpoints.
+    Порядок ключей совпадает с порядком обхода сверху вниз (родитель раньше потомков).
+    Обход идёт по путям в bytes: scandir не декодирует имя каждого файла и не создаёт для него str.
+    В str переводятся только ключи результата, по одному на директорию.
+    Обходится абсолютный путь без символических ссылок, чтобы проверки по точкам монтирования и
+    исключённым префиксам работали и для относительных целей; ключи результата записываются
+    от пути цели в том виде, в каком он был передан.
+    """
+    real_directory = os.fsencode(os.path.realpath(target_directory))
+    entries = walk_directories(real_directory, None, root_dev, excluded_prefixes, mountpoints, executor)
+    sizes = {dirpath: own_size for dirpath, own_size, _ in entries}
+
+    # В обратном порядке обхода потомки обрабатываются раньше родителей: к моменту,
+    # когда размер директории прибавляется к родителю, её собственное поддерево уже учтено
+    for dirpath, _, parent in reversed(entries):
+        if parent is not None:
+            sizes[parent] += sizes[dirpath]
 
-    return total_size
+    # Остаток пути после реального пути цели переносится на путь цели (ниже цели ссылки не раскрываются)
+    target_prefix = target_directory.rstrip(os.sep)
+    real_prefix_length = len(real_directory.rstrip(BYTES_SEP))
+    return {
+        target_directory if dirpath == real_directory else target_prefix + os.fsdecode(dirpath[real_prefix_length:]): size
+        for dirpath, size in sizes.items()
+    }
 
-def get_last_recorded_size(cursor, dirpath):
+def get_last_recorded_sizes(cursor, target_directory):
     """
-    Возвращает последний сохранённый размер для директории.
-    Если директория отсутствует в базе, возвращает None.
+    Возвращает пары (путь, последний записанный размер) для директории и всего её поддерева одним запросом.
+    Сама директория выбирается точным совпадением, поддерево - диапазоном [prefix, prefix с увеличенным
+    последним символом), который в отличие от LIKE всегда обслуживается индексом и не зависит от '%' и '_' в путях.
+    Размеры берутся из latest_size, по одной строке на путь, без перебора истории.
     """
+    prefix = target_directory.rstrip(os.sep) + os.sep
     cursor.execute('''
-        SELECT size FROM directory_snapshot
+        SELECT path, size FROM latest_size
         WHERE path = ?
-        ORDER BY timestamp DESC
-        LIMIT 1;
-    ''', (dirpath,))
-    row = cursor.fetchone()
-    return row[0] if row else None
+        UNION ALL
+        SELECT path, size FROM latest_size
+        WHERE path >= ? AND path < ?;
+    ''', (target_directory, prefix, prefix[:-1] + chr(ord(os.sep) + 1)))
+    return cursor.fetchall()
 
-def log_query(query, params):
+def log_queries(query, rows):
+    """
+    Дописывает в журнал запросов по записи на каждый набор параметров, открывая файл один раз.
+    """
     with open("query_log.txt", "a") as log_file:
-        log_file.write(f"Query: {query}\nParameters: {params}\n\n")
+        log_file.write("".join(f"Query: {query}\nParameters: {params}\n\n" for params in rows))
+
+# Запросы записи вынесены в константы: каждый компилируется один раз и выполняется через executemany
+# для всего пакета строк (path, size, timestamp)
+INSERT_SNAPSHOT_QUERY = 'INSERT INTO directory_snapshot (path, size, timestamp) VALUES (?, ?, ?)'
+UPDATE_LATEST_SIZE_QUERY = 'INSERT OR REPLACE INTO latest_size (path, size, timestamp) VALUES (?, ?, ?)'
 
 def record_sizes(target_directories, db_path):
     """
     Записывает размеры только тех директорий, которые отсутствуют или изменились в базе данных.
     """
-    updated_directories = []  # Список директорий с изменениями
+    # Директории с изменениями: путь -> новый размер. Словарь схлопывает повторы одного пути,
+    # поэтому в одном запуске для пути вставляется не больше одной записи
+    updated_directories = {}
     timestamp = int(time.time())
-    partitions = psutil.disk_partitions(all=True)
-    excluded_mounts = {partition.mountpoint for partition in partitions if "loop" in partition.opts or partition.fstype in {"proc", "sysfs", "tmpfs", "devpts", "cgroup", "squashfs", "devtmpfs", "overlay", "fusectl", "fuse.sshfs"}}
+    mountpoints, excluded_mounts, excluded_prefixes = get_mounts()
 
-    with sqlite3.connect(db_path) as conn:
+    last_sizes = {}  # Последний известный размер для каждого пути, включая записанные в этом запуске
+
+    # isolation_level=None отключает неявные транзакции модуля sqlite3: границы единственной
+    # транзакции записи задаются явно через BEGIN IMMEDIATE и COMMIT
+    # cached_statements хранит разобранные запросы соединения, в том числе запрос последних размеров,
+    # который повторяется для каждой цели
+    with sqlite3.connect(db_path, isolation_level=None, cached_statements=256) as conn:
+        # WAL и synchronous=NORMAL заметно ускоряют запись, кеш страниц в 64 МБ держит B-дерево индекса в памяти
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-65536')
+        # Страницы базы читаются через отображение файла в память, без отдельного pread на каждую
+        conn.execute('PRAGMA mmap_size=268435456')
         cursor = conn.cursor()
+
+        # Пропускаем целевые директории, которые являются псевдо-файловыми системами
+        scan_targets = []
         for target_directory in target_directories:
-            # Пропускаем целевые директории, которые являются псевдо-файловыми системами
             if target_directory in excluded_mounts:
                 print(f"Skipping pseudo-filesystem directory: {target_directory}")
-                continue
-
-            root_dev = get_root_dev(target_directory)
-            dir_size = get_size(target_directory, root_dev, excluded_mounts)
-            last_size = get_last_recorded_size(cursor, target_directory)
-            # Проверяем, нужно ли обновить базу данных для основного каталога
-            if last_size is None or last_size != dir_size:
-                query = 'INSERT INTO directory_snapshot (path, size, timestamp) VALUES (?, ?, ?)'
-                params = (target_directory, dir_size, timestamp)
-                log_query(query, params)
-                cursor.execute(query, params)
-                updated_directories.append((target_directory, dir_size))  # Добавляем в список изменений
-            # Обход всех поддиректорий
-            for dirpath, dirnames, _ in os.walk(target_directory, topdown=True):
-                # Пропускаем примонтированные поддиректории
-                dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) not in excluded_mounts and not os.path.ismount(os.path.join(dirpath, d))]
-                dir_size = get_size(dirpath, root_dev, excluded_mounts)
-                last_size = get_last_recorded_size(cursor, dirpath)
-                # Проверяем, нужно ли обновить базу данных
-                if last_size is None or last_size != dir_size:
-                    query = 'INSERT INTO directory_snapshot (path, size, timestamp) VALUES (?, ?, ?)'
-                    params = (dirpath, dir_size, timestamp)
-                    log_query(query, params)
-                    cursor.execute(query, params)
-                    updated_directories.append((dirpath, dir_size))  # Добавляем в список изменений
-        conn.commit()
+            else:
+                scan_targets.append(target_directory)
+
+        # Последние сохранённые размеры всех поддеревьев читаются до начала обхода, по одному запросу на цель,
+        # и дальше сравниваются в памяти. Для пересекающихся целей значения совпадают, берётся первое
+        for target_directory in scan_targets:
+            for path, size in get_last_recorded_sizes(cursor, target_directory):
+                last_sizes.setdefault(path, size)
+
+        scanned_paths = set()  # Директории, уже обойденные в этом запуске
+        # Пул создаётся только если есть что сканировать; with завершает его и при ошибке в обходе
+        if scan_targets:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+                for target_directory in scan_targets:
+                    # Цель внутри уже обойденной цели повторно не сканируется: её поддерево уже посчитано
+                    # и записано, повторный обход не нашёл бы изменений
+                    if target_directory in scanned_paths:
+                        continue
+
+                    root_dev = get_root_dev(target_directory)
+                    # Размеры целевой директории и всех поддиректорий за один обход
+                    directory_sizes = get_directory_sizes(target_directory, root_dev, excluded_prefixes, mountpoints, executor)
+                    scanned_paths.update(directory_sizes)
+                    for dirpath, dir_size in directory_sizes.items():
+                        last_size = last_sizes.get(dirpath)
+                        # Проверяем, нужно ли обновить базу данных
+                        if last_size is None or last_size != dir_size:
+                            last_sizes[dirpath] = dir_size
+                            updated_directories[dirpath] = dir_size  # Добавляем в список изменений
+
+        # Новые записи, вставляются одним пакетом
+        rows = [(dirpath, dir_size, timestamp) for dirpath, dir_size in updated_directories.items()]
+
+        # Все новые записи вставляются одним пакетом в одной явной транзакции
+        # BEGIN IMMEDIATE сразу берёт блокировку на запись, чтобы транзакция не упёрлась в неё посередине
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.executemany(INSERT_SNAPSHOT_QUERY, rows)
+        # Последние размеры обновляются в той же транзакции, что и история
+        cursor.executemany(UPDATE_LATEST_SIZE_QUERY, rows)
+        conn.execute('COMMIT')
+
+    if rows and is_query_log_enabled():
+        log_queries(INSERT_SNAPSHOT_QUERY, rows)
     
 
     # Выводим список директорий, у которых были изменения
     if not is_running_in_cron():
-        for dirpath, dir_size in updated_directories:
+        for dirpath, dir_size in updated_directories.items():
             print(f"Updated: {dirpath}, Size: {dir_size}")
 
 if __name__ == "__main__":